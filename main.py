@@ -19,6 +19,7 @@ from collections import OrderedDict
 faulthandler.enable()
 import utils
 from modules.sync_batchnorm import convert_model
+from modules.openai.model import fuse_conv_bn, quantize_mlps
 from seq_scripts import seq_train, seq_eval, seq_feature_generation
 from torch.cuda.amp import autocast as autocast
 
@@ -187,6 +188,13 @@ class Processor():
             self.load_model_weights(model, self.arg.load_weights)
         elif self.arg.load_checkpoints:
             self.load_checkpoint_weights(model, optimizer)
+        if self.arg.phase != 'train':
+            # BN statistics are fixed at inference, so fold them into the convs of the ResNet backbone
+            fuse_conv_bn(model.conv2d)
+            if self.arg.quantize:
+                if self.device.output_device != "cpu":
+                    raise ValueError("Dynamic int8 quantization only runs on CPU, set --device None to use it")
+                quantize_mlps(model.conv2d.cpu())
         model = self.model_to_device(model)
         self.kernel_sizes = model.conv1d.kernel_size
         print("Loading model finished.")
@@ -199,11 +207,12 @@ class Processor():
             raise ValueError("AMP equipped with DataParallel has to manually write autocast() for each forward function, you can choose to do this by yourself")
             #model.conv2d = nn.DataParallel(model.conv2d, device_ids=self.device.gpu_list, output_device=self.device.output_device)
         model = convert_model(model)
-        model.cuda()
+        if self.device.output_device != "cpu":
+            model.cuda()
         return model
 
     def load_model_weights(self, model, weight_path):
-        state_dict = torch.load(weight_path)
+        state_dict = torch.load(weight_path, map_location="cpu")  # weights are copied onto the model wherever it lives
         if len(self.arg.ignore_weights):
             for w in self.arg.ignore_weights:
                 if state_dict.pop(w, None) is not None:
@@ -224,7 +233,7 @@ class Processor():
 
     def load_checkpoint_weights(self, model, optimizer):
         self.load_model_weights(model, self.arg.load_checkpoints)
-        state_dict = torch.load(self.arg.load_checkpoints)
+        state_dict = torch.load(self.arg.load_checkpoints, map_location="cpu")
 
         if len(torch.cuda.get_rng_state_all()) == len(state_dict['rng_state']['cuda']):
             print("Loading random seeds...")
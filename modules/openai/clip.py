@@ -10,11 +10,11 @@ from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from .model import build_model
+from .model import build_model, compile_transformer
 
 
-if packaging.version.parse(torch.__version__) < packaging.version.parse("1.7.1"):
-    warnings.warn("PyTorch version 1.7.1 or higher is recommended")
+if packaging.version.parse(torch.__version__) < packaging.version.parse("2.0"):
+    warnings.warn("PyTorch version 2.0 or higher is required for F.scaled_dot_product_attention")
 
 
 __all__ = ["available_models", "load"]
@@ -69,7 +69,7 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
-def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None):
+def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None, compile_visual: bool = False):
     """Load a CLIP model
 
     Parameters
@@ -86,6 +86,9 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     download_root: str
         path to download the model files; by default, it uses "~/.cache/clip"
 
+    compile_visual : bool
+        Whether to compile the visual transformer with torch.compile (non-JIT model only, PyTorch >= 2.2).
+
     Returns
     -------
     model : torch.nn.Module
@@ -117,6 +120,8 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
         model = build_model(state_dict or model.state_dict()).to(device)
         if str(device) == "cpu":
             model.float()
+        if compile_visual:
+            compile_transformer(model)
         return model
 
     # patch the device names
@@ -1,3 +1,4 @@
+import math
 from collections import OrderedDict
 from typing import Tuple, Union
 
@@ -5,6 +6,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torch.utils.checkpoint import checkpoint
 
 class Bottleneck(nn.Module):
@@ -67,27 +69,23 @@ class AttentionPool2d(nn.Module):
 
     def forward(self, x):
         x = x.flatten(start_dim=2).permute(2, 0, 1)  # NCHW -> (HW)NC
-        x = torch.cat([x.mean(dim=0, keepdim=True), x], dim=0)  # (HW+1)NC
-        x = x + self.positional_embedding[:, None, :].to(x.dtype)  # (HW+1)NC
-        x, _ = F.multi_head_attention_forward(
-            query=x[:1], key=x, value=x,
-            embed_dim_to_check=x.shape[-1],
-            num_heads=self.num_heads,
-            q_proj_weight=self.q_proj.weight,
-            k_proj_weight=self.k_proj.weight,
-            v_proj_weight=self.v_proj.weight,
-            in_proj_weight=None,
-            in_proj_bias=torch.cat([self.q_proj.bias, self.k_proj.bias, self.v_proj.bias]),
-            bias_k=None,
-            bias_v=None,
-            add_zero_attn=False,
-            dropout_p=0,
-            out_proj_weight=self.c_proj.weight,
-            out_proj_bias=self.c_proj.bias,
-            use_separate_proj_weight=True,
-            training=self.training,
-            need_weights=False
-        )
+        HW, N, C = x.shape
+        head_dim = C // self.num_heads
+        positional_embedding = self.positional_embedding[:, None, :].to(x.dtype)
+        mean = x.mean(dim=0, keepdim=True) + positional_embedding[:1]  # 1NC
+        x = x + positional_embedding[1:]  # (HW)NC
+
+        def heads(t):  # LNC -> (N*heads)L(head_dim)
+            return t.reshape(t.shape[0], N * self.num_heads, head_dim).transpose(0, 1)
+
+        # only the mean token queries, so it is scored against itself and the (HW) tokens separately
+        # instead of building the (HW+1)NC key/value sequence with torch.cat
+        q = heads(self.q_proj(mean)) * head_dim ** -0.5
+        k_mean, v_mean = heads(self.k_proj(mean)), heads(self.v_proj(mean))
+        k, v = heads(self.k_proj(x)), heads(self.v_proj(x))
+        attn = torch.cat([(q * k_mean).sum(dim=-1, keepdim=True), torch.bmm(q, k.transpose(1, 2))], dim=-1).softmax(dim=-1)
+        x = attn[..., :1] * v_mean + torch.bmm(attn[..., 1:], v)  # (N*heads)1(head_dim)
+        x = self.c_proj(x.transpose(0, 1).reshape(1, N, C))
         return x.squeeze(0)
 
 
@@ -135,7 +133,8 @@ class ModifiedResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def forward(self, x, T=None):
+        # T (frames per video) is only used by the ViT branch, but encode_image passes it to either backbone
         def stem(x):
             x = self.relu1(self.bn1(self.conv1(x)))
             x = self.relu2(self.bn2(self.conv2(x)))
@@ -144,6 +143,9 @@ class ModifiedResNet(nn.Module):
             return x
 
         x = x.type(self.conv1.weight.dtype)
+        # frames arrive as NCHW, so this is one layout copy of the input; it lets every conv of the stem and
+        # the bottlenecks run NHWC kernels without per-layer transposes
+        x = x.contiguous(memory_format=torch.channels_last)
         x = stem(x)
         x = self.layer1(x)
         x = self.layer2(x)
@@ -158,14 +160,27 @@ class LayerNorm(nn.LayerNorm):
     """Subclass torch's LayerNorm to handle fp16."""
 
     def forward(self, x: torch.Tensor):
+        if x.dtype == torch.float32:
+            return super().forward(x)
+        if x.is_cuda and not (torch.is_grad_enabled() and self.weight.requires_grad):
+            # the CUDA kernel accumulates statistics in fp32, so fp16/bf16 can be normalized directly;
+            # trainable LNs keep the fp32 path so their weight/bias gradients stay in fp32
+            with torch.autocast("cuda", enabled=False):
+                return F.layer_norm(x, self.normalized_shape, self.weight.to(x.dtype), self.bias.to(x.dtype), self.eps)
         orig_type = x.dtype
         ret = super().forward(x.type(torch.float32))
         return ret.type(orig_type)
 
 
+@torch.jit.script
+def quick_gelu(x: torch.Tensor):
+    # scripted so the TorchScript fuser emits one pointwise kernel instead of three
+    return x * torch.sigmoid(1.702 * x)
+
+
 class QuickGELU(nn.Module):
     def forward(self, x: torch.Tensor):
-        return x * torch.sigmoid(1.702 * x)
+        return quick_gelu(x)
 
 
 class ResidualAttentionBlock(nn.Module):
@@ -180,7 +195,7 @@ class ResidualAttentionBlock(nn.Module):
             ("c_proj", nn.Linear(d_model * 4, d_model))
         ]))
         self.ln_2 = LayerNorm(d_model)
-        self.attn_mask = attn_mask
+        self.register_buffer("attn_mask", attn_mask, persistent=False)  # follows the module across devices
         self.S_Adapter = Adapter(d_model, skip_connect=False)
         #self.S_Adapter = Adapter(d_model)
         self.MLP_Adapter = Adapter(d_model, skip_connect=False)
@@ -193,20 +208,37 @@ class ResidualAttentionBlock(nn.Module):
         self.checkpointing = checkpointing
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, torch.concat((x, self.prefix_embedding_k.repeat(1, x.shape[1], 1)), 0), torch.concat((x, self.prefix_embedding_v.repeat(1, x.shape[1], 1)), 0), need_weights=False, attn_mask=self.attn_mask)[0]
+        if self.attn_mask is not None and self.attn_mask.dtype != x.dtype:
+            self.attn_mask = self.attn_mask.to(x.dtype)
+        L, N, D = x.shape
+        # reuse the weights of self.attn, but route through scaled_dot_product_attention so flash / memory-efficient kernels can be picked
+        q, k, v = F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias).chunk(3, dim=-1)  # packed QKV in one GEMM
+        _, w_k, w_v = self.attn.in_proj_weight.chunk(3)
+        _, b_k, b_v = self.attn.in_proj_bias.chunk(3)
+        # prefix rows are shared by the whole batch: project them once and broadcast, so only the projected K/V are concatenated
+        k = torch.concat((k, F.linear(self.prefix_embedding_k, w_k, b_k).expand(-1, N, -1)), 0)
+        v = torch.concat((v, F.linear(self.prefix_embedding_v, w_v, b_v).expand(-1, N, -1)), 0)
+        q, k, v = [t.view(t.shape[0], N, self.attn.num_heads, -1).permute(1, 2, 0, 3) for t in (q, k, v)]  # LND -> N(heads)L(head_dim)
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=self.attn_mask)
+        x = x.permute(2, 0, 1, 3).reshape(L, N, D)  # N(heads)L(head_dim) -> LND
+        return self.attn.out_proj(x)
 
     def forward(self, x: torch.Tensor):
+        # the adapter output is accumulated in place into the branch output, so each residual update allocates once
         if self.checkpointing:
-            x = x + checkpoint(self.attention, checkpoint(self.ln_1,x)) + self.S_Adapter(x)
+            # non-reentrant checkpointing also back-propagates when x itself needs no grad (block 0), so the first
+            # block's prefix embeddings are trained too; the reentrant variant silently dropped their gradients
+            h = checkpoint(lambda y: self.attention(self.ln_1(y)), x, use_reentrant=False)
         else:
-            x = x + self.attention(self.ln_1(x)) + self.S_Adapter(x)
+            h = self.attention(self.ln_1(x))
+        x = x + h.add_(self.S_Adapter(x))
         #x = x + self.S_Adapter(self.attention(self.ln_1(x)))
         #x = x + self.mlp(self.ln_2(x))
         if self.checkpointing:
-             x = x + checkpoint(self.mlp, checkpoint(self.ln_2,x)) + self.MLP_Adapter(x)
+            h = checkpoint(lambda y: self.mlp(self.ln_2(y)), x, use_reentrant=False)
         else:
-            x = x + self.mlp(self.ln_2(x)) + self.MLP_Adapter(x)
+            h = self.mlp(self.ln_2(x))
+        x = x + h.add_(self.MLP_Adapter(x))
         #x = x +  self.MLP_Adapter(self.mlp(self.ln_2(x)))
         return x
 
@@ -239,14 +271,16 @@ class AggregationBlock(nn.Module):
             ("c_proj", nn.Linear(d_model * 1, d_model))
         ]))
         self.ln_2 = LayerNorm(d_model)
-        self.attn_mask = attn_mask
+        self.register_buffer("attn_mask", attn_mask, persistent=False)
 
-    def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x[:1], x[1:], x[1:], need_weights=False, attn_mask=self.attn_mask)[0]   # cls token attends to others
+    def attention(self, cls: torch.Tensor, x: torch.Tensor):
+        if self.attn_mask is not None and self.attn_mask.dtype != x.dtype:
+            self.attn_mask = self.attn_mask.to(x.dtype)
+        return self.attn(cls, x, x, need_weights=False, attn_mask=self.attn_mask)[0]   # cls token attends to others
 
     def forward(self, x: torch.Tensor, cls):
-        cls = cls + self.attention(self.ln_1(torch.concat((cls, x), 0)))
+        # LayerNorm is row-wise, so normalizing cls and x separately equals normalizing their concat without copying x
+        cls = cls + self.attention(self.ln_1(cls), self.ln_1(x))
         cls = cls + self.mlp(self.ln_2(cls))
         return cls
 
@@ -257,19 +291,17 @@ class UnfoldTemporalWindows(nn.Module):
         self.window_stride = window_stride
         self.window_dilation = window_dilation
 
-        self.padding = (window_size + (window_size-1) * (window_dilation-1) - 1) // 2
-        self.unfold = nn.Unfold(kernel_size=(self.window_size, 1),
-                                dilation=(self.window_dilation, 1),
-                                stride=(self.window_stride, 1),
-                                padding=(self.padding, 0))
+        self.window_span = window_size + (window_size-1) * (window_dilation-1)
+        self.padding = (self.window_span - 1) // 2
 
     def forward(self, x, T):
-        # Input shape: (N,C,T,H,W), out: (N,C,T,V*window_size)
-        NT, C, P = x.shape
-        x = x.view(-1, T, C, P).permute(0,2,1,3)
-        x = self.unfold(x)  #(N, C*Window_Size, T, P)
-        # Permute extra channels from window size to the graph dimension; -1 for number of windows
-        x = x.view(-1, C, self.window_size, T, P).permute(0,3,1,2,4).reshape(NT, C, -1)# (NT)C(SP)
+        # Input shape: (P,NT,C), out: (window_size*P,NT,C)
+        P, NT, C = x.shape
+        x = x.view(P, -1, T, C)  # PNTC
+        x = F.pad(x, (0, 0, self.padding, self.padding))
+        # sliding windows along T as a strided view, (P,N,T,C,window_size)
+        x = x.unfold(2, self.window_span, self.window_stride)[..., ::self.window_dilation]
+        x = x.movedim(-1, 0).reshape(-1, NT, C)  # (SP)(NT)C
         return x
 
 class Correlation_Module(nn.Module):
@@ -278,9 +310,9 @@ class Correlation_Module(nn.Module):
 
     def forward(self, x, upfold):
         L, N, D = x.shape
-        import math
-        affinities = torch.einsum('lnd,ond->lon', x, upfold)/math.sqrt(D)
-        features = torch.einsum('lon,ond->lnd', F.sigmoid(affinities)-0.5, upfold)
+        # sigmoid(a)-0.5 == 0.5*tanh(a/2); the 1/2 inside is folded into the scaling of the (short) query
+        affinities = torch.einsum('lnd,ond->lon', x * (0.5 / math.sqrt(D)), upfold)
+        features = torch.einsum('lon,ond->lnd', torch.tanh(affinities), upfold) * 0.5
 
         return features
 
@@ -290,18 +322,22 @@ class TemporalAggregationBlock(nn.Module):
 
         self.attn = Correlation_Module()
         self.ln_1 = LayerNorm(d_model)
-        self.attn_mask = attn_mask
+        self.register_buffer("attn_mask", attn_mask, persistent=False)
         self.upfold = UnfoldTemporalWindows(5)
 
     def attention(self, x: torch.Tensor, T):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        x_upfold = self.upfold(x[1:].permute(1,2,0), T).permute(2,0,1)   #LND -> NDL -> LND
+        x_upfold = self.upfold(x[1:], T)
         return self.attn(x[:1], x_upfold)   # cls token attends to others
 
     def forward(self, x: torch.Tensor, T):
         cls = self.attention(self.ln_1(x), T)
         return cls
 
+def _refresh_branch_flags(module, incompatible_keys):
+    # the branch-skipping flags depend on the loaded ada weights, so recompute them for the current mode
+    module.train(module.training)
+
+
 class Transformer(nn.Module):
     def __init__(self, width: int, layers: int, heads: int, attn_mask: torch.Tensor = None, checkpointing=True):
         super().__init__()
@@ -316,18 +352,31 @@ class Transformer(nn.Module):
         self.aggblocks = nn.Sequential(*[AggregationBlock(width, heads, attn_mask) for _ in range(layers)])  # 14 for ViT-B/16
         self.taggblocks = TemporalAggregationBlock(width, heads, attn_mask)
         self.temporal_ada_weight = nn.Parameter(torch.zeros(1), requires_grad=True)
+        self.with_temporal = True
+        self.register_load_state_dict_post_hook(_refresh_branch_flags)
 
-    def forward(self, x: torch.Tensor, T=None):
+    def train(self, mode: bool = True):
+        super().train(mode)
+        # decided once per train/eval switch (and after loading weights) rather than with a host sync in every forward;
+        # call train(self.training) again after editing temporal_ada_weight in place
+        self.with_temporal = mode or self.temporal_ada_weight.abs().item() >= 1e-6
+        return self
+
+    def forward(self, x: torch.Tensor, T=None, with_cls=True):
         L, N, D = x.shape
-        query = self.query.repeat(1,N,1)
-        for i in range(len(self.resblocks)):
-            x = self.resblocks[i](x)
+        query = self.query.expand(-1, N, -1) if with_cls else None
+        for resblock, aggblock in zip(self.resblocks, self.aggblocks):
+            x = resblock(x)
+            if query is None:
+                continue
             if self.checkpointing:
-                query = checkpoint(self.aggblocks[i], x, query)
+                query = checkpoint(aggblock, x, query, use_reentrant=False)
             else:
-                query = self.aggblocks[i](x, query)
+                query = aggblock(x, query)
+        if not self.with_temporal:
+            return x, query  # the temporal branch would be scaled to zero
         if self.checkpointing:
-            x = x + checkpoint(self.taggblocks, x, T) * self.temporal_ada_weight
+            x = x + checkpoint(self.taggblocks, x, T, use_reentrant=False) * self.temporal_ada_weight
         else:
             x = x + self.taggblocks(x, T) * self.temporal_ada_weight
         return x, query
@@ -351,6 +400,8 @@ class VisionTransformer(nn.Module):
         self.ln_post_cls = LayerNorm(width)
         self.proj = nn.Parameter(scale * torch.randn(width, output_dim))
         self.ada_weight = nn.Parameter(torch.tensor([0.5, 0.5]), requires_grad=True)
+        self.with_cls = True
+        self.register_load_state_dict_post_hook(_refresh_branch_flags)
 
         ## initialize S_Adapter
         for n, m in self.transformer.named_modules():
@@ -370,6 +421,12 @@ class VisionTransformer(nn.Module):
                             nn.init.constant_(m2.weight, 0)
                             nn.init.constant_(m2.bias, 0)
 
+    def train(self, mode: bool = True):
+        super().train(mode)
+        # at inference, the aggregation blocks and ln_post_cls can be skipped when their output would be scaled to zero
+        self.with_cls = mode or self.ada_weight[1].abs().item() >= 1e-6
+        return self
+
     def forward(self, x: torch.Tensor, T):
         #with torch.no_grad():
         x = self.conv1(x)  # shape = [*, width, grid, grid]
@@ -380,10 +437,12 @@ class VisionTransformer(nn.Module):
         x = self.ln_pre(x)
 
         x = x.permute(1, 0, 2)  # NLD -> LND
-        x, new_cls = self.transformer(x, T)
+        x, new_cls = self.transformer(x, T, self.with_cls)
         x = x.permute(1, 0, 2)  # LND -> NLD
 
-        x = self.ln_post(x[:, 0, :]) * self.ada_weight[0] + self.ln_post_cls(new_cls.permute(1, 0, 2))[:,0]* self.ada_weight[1]
+        x = self.ln_post(x[:, 0, :]) * self.ada_weight[0]
+        if self.with_cls:
+            x = x + self.ln_post_cls(new_cls.permute(1, 0, 2))[:,0]* self.ada_weight[1]
 
         if self.proj is not None:
             x = x @ self.proj
@@ -486,6 +545,38 @@ def convert_weights(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
 
 
+def compile_transformer(model: nn.Module):
+    """Compile the visual transformer in place with nn.Module.compile, keeping the module tree (and state dict keys) unchanged"""
+    if isinstance(model.visual, VisionTransformer):
+        # N = batch * frames changes with every video, so trace with dynamic shapes instead of recompiling per length
+        model.visual.transformer.compile(dynamic=True)
+    return model
+
+
+def quantize_mlps(model: nn.Module):
+    """Dynamically quantize the MLP and adapter linears of the visual transformer to int8 (CPU inference only, after loading trained weights)"""
+    names = {n for n, m in model.named_modules() if isinstance(m, nn.Linear) and 'resblocks' in n and '.mlp.' in n}
+    return torch.ao.quantization.quantize_dynamic(model, names, dtype=torch.qint8, inplace=True)
+
+
+def fuse_conv_bn(model: nn.Module):
+    """Fold the BatchNorm layers of the ResNet backbone into their preceding convolutions (inference only)"""
+
+    def _fuse(module, conv, bn):
+        if isinstance(getattr(module, bn), nn.modules.batchnorm._BatchNorm):
+            setattr(module, conv, fuse_conv_bn_eval(getattr(module, conv), getattr(module, bn)))
+            setattr(module, bn, nn.Identity())
+
+    model.eval()
+    for m in list(model.modules()):
+        if isinstance(m, (ModifiedResNet, Bottleneck)):
+            for i in [1, 2, 3]:
+                _fuse(m, f"conv{i}", f"bn{i}")
+        if isinstance(m, Bottleneck) and m.downsample is not None:
+            _fuse(m.downsample, "0", "1")
+    return model
+
+
 def build_model(state_dict: dict):
     vit = "visual.proj" in state_dict
 
@@ -521,4 +612,6 @@ def build_model(state_dict: dict):
 
     #convert_weights(model)
     model.load_state_dict(state_dict, strict=False)
+    if not vit:
+        model.visual.to(memory_format=torch.channels_last)  # conv weights in NHWC, matching the channels_last inputs
     return model
\ No newline at end of file
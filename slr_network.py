@@ -34,7 +34,7 @@ class SLRModel(nn.Module):
     def __init__(
             self, num_classes, c2d_type, conv_type, use_bn=False,
             hidden_size=1024, gloss_dict=None, loss_weights=None,
-            weight_norm=True, share_classifier=True
+            weight_norm=True, share_classifier=True, compile_visual=False
     ):
         super(SLRModel, self).__init__()
         self.decoder = None
@@ -45,7 +45,7 @@ class SLRModel(nn.Module):
 
         # For openai clip
         from modules.openai import clip
-        self.conv2d = clip.load(c2d_type)
+        self.conv2d = clip.load(c2d_type, compile_visual=compile_visual)
 
         self.conv1d = TemporalConv(input_size=512, #768 for ViT-L/14, 512 for ViT-B/16, 512 for ViT-B/32, 1024 for RN50
                                    hidden_size=hidden_size,
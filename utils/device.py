@@ -30,7 +30,8 @@ class GpuDataParallel(object):
 
     def data_to_device(self, data):
         if isinstance(data, torch.FloatTensor):
-            return data.to(self.output_device)
+            # batches come from pinned memory, so the copy can overlap with compute
+            return data.to(self.output_device, non_blocking=True)
         elif isinstance(data, torch.DoubleTensor):
             return data.float().to(self.output_device)
         elif isinstance(data, torch.ByteTensor):
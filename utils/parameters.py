@@ -105,6 +105,11 @@ def get_parser():
         '--decode-mode',
         default="max",
         help='search mode for decode, max or beam')
+    parser.add_argument(
+        '--quantize',
+        type=str2bool,
+        default=False,
+        help='int8 dynamic quantization of the CLIP MLP/adapter linears for CPU inference (test and features phases)')
     parser.add_argument(
         '--ignore-weights',
         type=str,